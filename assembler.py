@@ -2,220 +2,340 @@
 # Author: utchchhwas
 
 from pprint import pprint
-from sys import argv
-import os
-import re
+from sys import argv, intern, stdin
+import struct
 
 
 OPCODES = {
-    'or':   '0000',
-    'subi': '0001',
-    'ori':  '0010',
-    'sub':  '0011',
-    'add':  '0100',
-    'lw':   '0101',
-    'j':    '0110',
-    'sll':  '0111',
-    'sw':   '1000',
-    'addi': '1001',
-    'srl':  '1010',
-    'beq':  '1011',
-    'nor':  '1100',
-    'and':  '1101',
-    'andi': '1110',
-    'bneq': '1111'
+    'or':   0b0000,
+    'subi': 0b0001,
+    'ori':  0b0010,
+    'sub':  0b0011,
+    'add':  0b0100,
+    'lw':   0b0101,
+    'j':    0b0110,
+    'sll':  0b0111,
+    'sw':   0b1000,
+    'addi': 0b1001,
+    'srl':  0b1010,
+    'beq':  0b1011,
+    'nor':  0b1100,
+    'and':  0b1101,
+    'andi': 0b1110,
+    'bneq': 0b1111
 }
 
 REGISTERS = {
-    '$zero':    '0000',
-    '$t0':      '0001',
-    '$t1':      '0010',
-    '$t2':      '0011',
-    '$t3':      '0100',
-    '$t4':      '0101',
-    '$sp':      '0110'
+    '$zero':    0b0000,
+    '$t0':      0b0001,
+    '$t1':      0b0010,
+    '$t2':      0b0011,
+    '$t3':      0b0100,
+    '$t4':      0b0101,
+    '$sp':      0b0110
 }
 
 
-def parseLabel(line):
-    return re.match(r'([_a-zA-Z][_a-zA-Z0-9]*):', line)
+# instruction format and operand shapes of each mnemonic:
+# r = register, i = immediate, m = offset(register), l = label
+OPSPEC = {
+    'or':   ('rtype',  'rrr'),
+    'subi': ('itype',  'rri'),
+    'ori':  ('itype',  'rri'),
+    'sub':  ('rtype',  'rrr'),
+    'add':  ('rtype',  'rrr'),
+    'lw':   ('mem',    'rm'),
+    'j':    ('jump',   'l'),
+    'sll':  ('itype',  'rri'),
+    'sw':   ('mem',    'rm'),
+    'addi': ('itype',  'rri'),
+    'srl':  ('itype',  'rri'),
+    'beq':  ('branch', 'rrl'),
+    'nor':  ('rtype',  'rrr'),
+    'and':  ('rtype',  'rrr'),
+    'andi': ('itype',  'rri'),
+    'bneq': ('branch', 'rrl')
+}
+
+
+def isLabelName(token):
+    return token.isascii() and token.isidentifier()
+
+
+def isImmediate(token):
+    digits = token[1:] if token[:1] == '-' else token
+    return digits.isascii() and digits.isdigit()
+
+
+OPERAND_CHECKS = {
+    'r':    REGISTERS.__contains__,
+    'i':    isImmediate,
+    'l':    isLabelName
+}
 
 
 def parse(line):
+    if line.endswith(':') and isLabelName(line[:-1]):
+        return 'label', (intern(line[:-1]),)
+
+    parts = line.split(None, 1)
+    if not parts or parts[0] not in OPSPEC:
+        raise RuntimeError('Unknown instruction format')
+
+    kind, shape = OPSPEC[parts[0]]
+    operands = [op.strip() for op in parts[1].split(',')] if len(parts) == 2 else []
+    if len(operands) != len(shape):
+        raise RuntimeError('Unknown instruction format')
+
+    tk = [parts[0]]
+    for op, expected in zip(operands, shape):
+        if expected == 'm':
+            # offset(register) gives two tokens, the offset and the base register
+            offset, _, base = op.partition('(')
+            base = base[:-1] if base.endswith(')') else ''
+            valid = offset.isascii() and offset.isdigit() and base in REGISTERS
+            tk += [offset, base]
+        else:
+            valid = OPERAND_CHECKS[expected](op)
+            # label names are interned so label table key comparisons can match by identity instead of comparing characters
+            tk.append(intern(op) if expected == 'l' else op)
 
-    g = re.match(r'(or|sub|add|nor|and)[ ]+(\$t[0-4]|\$zero|\$sp),[ ]*(\$t[0-4]|\$zero|\$sp),[ ]*(\$t[0-4]|\$zero|\$sp)', line)
-    if g:
-        return g.groups()
+        if not valid:
+            raise RuntimeError('Unknown instruction format')
 
-    g = re.match(r'(subi|ori|addi|andi|sll|srl)[ ]+(\$t[0-4]|\$zero|\$sp),[ ]*(\$t[0-4]|\$zero|\$sp),[ ]*([-]?[0-9]+)', line)
-    if g:
-        return g.groups()
+    return kind, tuple(tk)
 
-    g = re.match(r'(lw|sw)[ ]+(\$t[0-4]|\$zero|\$sp),[ ]*([0-9]+)\((\$t[0-4]|\$zero|\$sp)\)', line)
-    if g:
-        return g.groups()
 
-    g = re.match(r'(beq|bneq)[ ]+(\$t[0-4]|\$zero|\$sp),[ ]*(\$t[0-4]|\$zero|\$sp),[ ]*([_a-zA-Z][_a-zA-Z0-9]+)', line)
-    if g:
-        return g.groups()
+# bit widths of the fields of an encoded word, used for the debug print
+RI_FIELDS = (4, 4, 4, 4)
+J_FIELDS = (4, 8, 4)
 
-    g = re.match(r'(j)[ ]+([_a-zA-Z][_a-zA-Z0-9]*)', line)
-    if g:
-        return g.groups()
 
-    g =  re.match(r'([_a-zA-Z][_a-zA-Z0-9]*):', line)
-    if g:
-        return g.groups()
+# encoders work on already looked-up integer fields only, validation stays in the callers
+def encodeRI(opcode, field1, field2, field3):
+    return (opcode << 12) | (field1 << 8) | (field2 << 4) | (field3 & 0xF)
 
-    raise RuntimeError('Unknown instruction format')
 
+def encodeJ(opcode, jmpAddr):
+    return (opcode << 12) | ((jmpAddr & 0xFF) << 4)
 
-def getRTypeFormat(opcode, desReg, srcReg1, srcReg2):
-    fmt = [OPCODES[opcode], REGISTERS[srcReg1], REGISTERS[srcReg2], REGISTERS[desReg]]
-    return fmt
 
+def getRTypeFormat(opcode, desReg, srcReg1, srcReg2):
+    return encodeRI(OPCODES[opcode], REGISTERS[srcReg1], REGISTERS[srcReg2], REGISTERS[desReg])
 
-def getITypeFormat(opcode, desReg, srcReg, const):
-    constVal = int(const)
 
-    if constVal < -8 or constVal >= 8:
+def getITypeFormat(opcode, desReg, srcReg, constVal):
+    if not -8 <= constVal < 8:
         raise RuntimeError(f'Immediate value overflow {constVal}')
-        
-    if constVal < 0:
-        constVal += (1 << 32)
-
-    fmt = [OPCODES[opcode], REGISTERS[srcReg], REGISTERS[desReg], '{0:04b}'.format(constVal)[-4:]]
-    return fmt
 
+    # masking in encodeRI keeps the 4-bit two's complement of negative values
+    return encodeRI(OPCODES[opcode], REGISTERS[srcReg], REGISTERS[desReg], constVal)
 
-def getJTypeFormat(opcode, jmpAddr):
-    jmpAddrVal = int(jmpAddr)
 
+def getJTypeFormat(opcode, jmpAddrVal):
     if jmpAddrVal >= 256:
         raise RuntimeError(f'Jump address overflow {jmpAddrVal}')
 
-    fmt = [OPCODES[opcode], '{0:08b}'.format(jmpAddrVal)[-8:], '0000']
-    return fmt
+    return encodeJ(OPCODES[opcode], jmpAddrVal)
 
 
+def formatWord(word, fields):
+    bits = f'{word:016b}'
+    parts = []
+    pos = 0
+    for width in fields:
+        parts.append(bits[pos:pos+width])
+        pos += width
+    return ' '.join(parts)
 
-def preassemble(filename):
-    with open(filename) as infile, open(filename+".new.asm", 'w') as outfile:
-        while (line := infile.readline().strip()):
-            replacement_line = line
-            colon_pos = line.find(':')
-            if len(line) !=0 and colon_pos != -1 and colon_pos < len(line)-1:
-                # has a label and some extra code
-                label = line[:colon_pos+1]
-                replacement_line = line[colon_pos+1:].strip()
-                outfile.write(label+'\n')
 
-            if replacement_line[:4].lower() == "push":
-                arg = replacement_line[4:].strip()
-                replacement_line = "subi $sp, $sp, 1\nsw "+arg+", 0($sp)"
+# handlers take the parsed tokens, the label table and the instruction's own address
+def handleRType(tk, labels, lineNo):
+    return getRTypeFormat(tk[0], tk[1], tk[2], tk[3])
 
-            elif replacement_line[:3].lower() == "pop":
-                arg = replacement_line[3:].strip()
-                replacement_line = "lw "+arg+", 0($sp)\naddi $sp, $sp, 1"
 
-            outfile.write(replacement_line+"\n")
+def handleIType(tk, labels, lineNo):
+    return getITypeFormat(tk[0], tk[1], tk[2], int(tk[3]))
 
 
-def main():
-    if len(argv) != 2:
-        print("Invalid usage: python assembler.py [inputFile]")
-        exit(1)
+def handleMem(tk, labels, lineNo):
+    return getITypeFormat(tk[0], tk[1], tk[3], int(tk[2]))
 
-    preassemble(argv[1])
-    
-    try:
-        asmFile = open(argv[1] + '.new.asm', 'r')
-    except FileNotFoundError:
-        print(f'Error: {argv[1]} not found')
-        exit(1)
 
-    lines = asmFile.read().splitlines()
+def handleBranch(tk, labels, lineNo):
+    jumpLabel = tk[3]
 
-    binOutFile = open('output.bin', 'wb')
+    if jumpLabel not in labels:
+        raise RuntimeError('Unrecognized label')
 
-    print("Running Assembler...", end='\n\n')
+    jumpOffset = labels[jumpLabel] - (lineNo + 1)
 
-    labels = {}
-    lineNo = 0
+    return getITypeFormat(tk[0], tk[1], tk[2], jumpOffset)
+
+
+def handleJump(tk, labels, lineNo):
+    jumpLabel = tk[1]
+
+    if jumpLabel not in labels:
+        raise RuntimeError('Unrecognized label')
+
+    return getJTypeFormat(tk[0], labels[jumpLabel])
+
+
+HANDLERS = {
+    'rtype':    handleRType,
+    'itype':    handleIType,
+    'mem':      handleMem,
+    'branch':   handleBranch,
+    'jump':     handleJump
+}
+
+# kinds that refer to labels and are encoded once the whole file has been read
+FIXUP_KINDS = {'branch', 'jump'}
+
+
+def expandMacros(lines):
     for line in lines:
         line = line.strip()
-        tk = parseLabel(line)
-        if tk:
-            labels[tk[1]] = lineNo
+        if not line:
+            return
+
+        replacement_line = line
+        colon_pos = line.find(':')
+        if colon_pos != -1 and colon_pos < len(line)-1:
+            # has a label and some extra code
+            yield line[:colon_pos+1]
+            replacement_line = line[colon_pos+1:].strip()
+
+        mnemonic = replacement_line[:4].lower()
+        if mnemonic == "push":
+            arg = replacement_line[4:].strip()
+            yield "subi $sp, $sp, 1"
+            yield "sw "+arg+", 0($sp)"
+
+        elif mnemonic[:3] == "pop":
+            arg = replacement_line[3:].strip()
+            yield "lw "+arg+", 0($sp)"
+            yield "addi $sp, $sp, 1"
+
         else:
-            lineNo += 1
+            yield replacement_line
+
 
-    pprint(f'labels: {labels}')
+def assemble(filename, outFilename='output.bin', verbose=False):
+    labels = {}
+    # branches and jumps are emitted as placeholders and patched once all labels are known
+    fixups = []
+    # (line index, line, error) for each line that failed to assemble
+    errors = []
+    # (line index, line, lineNo, fields) for each non-label line, only kept for the verbose listing
+    listing = []
 
-    error = False
     lineNo = 0
-    for i, line in enumerate(lines):
-        line = line.strip()
-        try:
-            tk = parse(line.strip())
+    words = []
+    try:
+        with open(filename) as asmFile:
+            print("Running Assembler...", end='\n\n')
+
+            for i, line in enumerate(expandMacros(asmFile)):
+                try:
+                    kind, tk = parse(line)
+
+                    if kind == 'label':
+                        labels[tk[0]] = lineNo
+                        continue
+
+                    if kind in FIXUP_KINDS:
+                        word = 0
+                        fixups.append((i, line, lineNo, kind, tk))
+                    else:
+                        word = HANDLERS[kind](tk, labels, lineNo)
+
+                    if verbose:
+                        fields = J_FIELDS if kind == 'jump' else RI_FIELDS
+                        listing.append((i, line, lineNo, fields))
+                    words.append(word)
+                    lineNo += 1
+
+                except RuntimeError as e:
+                    errors.append((i, line, e))
+                    if verbose:
+                        listing.append((i, line, None, None))
 
-            isLabel = False
-            fmt = None
-            if tk[0] in {'or', 'sub', 'add', 'nor', 'and'}:
-                fmt = getRTypeFormat(tk[0], tk[1], tk[2], tk[3])
+    except FileNotFoundError:
+        print(f'Error: {filename} not found')
+        return False
+    except (OSError, UnicodeDecodeError) as e:
+        print(f'Error: cannot read {filename}: {e}')
+        return False
 
-            elif tk[0] in {'subi', 'ori', 'addi', 'andi', 'sll', 'srl'}:
-                fmt = getITypeFormat(tk[0], tk[1], tk[2], tk[3])
+    for i, line, lineNo, kind, tk in fixups:
+        try:
+            words[lineNo] = HANDLERS[kind](tk, labels, lineNo)
 
-            elif tk[0] in {'lw', 'sw'}:
-                fmt = getITypeFormat(tk[0], tk[1], tk[3], tk[2])
+        except RuntimeError as e:
+            errors.append((i, line, e))
 
-            elif tk[0] in {'beq', 'bneq'}:
-                jumpLabel = tk[3]
+    # fixup errors are found after the pass, put them back in source order
+    errors.sort(key=lambda error: error[0])
 
-                if jumpLabel not in labels:
-                    raise RuntimeError('Unrecognized label')
+    if verbose:
+        pprint(f'labels: {labels}')
 
-                jumpOffset = labels[jumpLabel] - (lineNo + 1)
+        failed = {i: e for i, _, e in errors}
+        for i, line, lineNo, fields in listing:
+            if i in failed:
+                print(f'Error on line {i+1}: {failed[i]} [{line}]', end='\n\n')
+                continue
 
-                fmt = getITypeFormat(tk[0], tk[1], tk[2], str(jumpOffset))
+            word = words[lineNo]
+            fmtStr = formatWord(word, fields)
 
-            elif tk[0] in {'j'}:
-                jumpLabel = tk[1]
+            print(f'#{lineNo:02d}: {line} => {fmtStr} \\ {word:04x}', end='\n\n')
+    else:
+        for i, line, e in errors:
+            print(f'Error on line {i+1}: {e} [{line}]', end='\n\n')
 
-                if jumpLabel not in labels:
-                    raise RuntimeError('Unrecognized label')
+    if errors:
+        print("Assembling unsuccessful ❌")
+        return False
 
-                jumpAddr = labels[jumpLabel]
-                
-                fmt = getJTypeFormat(tk[0], str(jumpAddr))
-                
-            else:
-                isLabel = True
+    # output is only created once the whole file assembled cleanly
+    try:
+        with open(outFilename, 'wb') as binOutFile:
+            binOutFile.write(struct.pack(f'>{len(words)}H', *words))
+    except OSError as e:
+        print(f'Error: cannot write {outFilename}: {e}')
+        return False
 
-            if not isLabel:
-                fmtStr = ' '.join(item for item in fmt)
-                fmtBytes = int(fmtStr.replace(' ', ''), 2).to_bytes(2, byteorder='big')
+    print("Assembling successful ✅")
+    return True
 
-                print(f'#{lineNo:02d}: {line} => {fmtStr} \ {fmtBytes.hex()}', end='\n\n')
 
-                binOutFile.write(fmtBytes)
-                lineNo += 1
+def main():
+    verbose = '--verbose' in argv[1:]
+    batch = '--stdin' in argv[1:]
+    args = [arg for arg in argv[1:] if arg not in {'--verbose', '--stdin'}]
 
-        except RuntimeError as e:
-            print(f'Error on line {i+1}: {e} [{line}]', end='\n\n')
-            error = True
+    if len(args) != (0 if batch else 1):
+        print("Invalid usage: python assembler.py [--verbose] [inputFile | --stdin]")
+        exit(1)
 
+    if not batch:
+        success = assemble(args[0], verbose=verbose)
+    else:
+        # one input file per line, each assembled to <inputFile>.bin
+        success = True
+        for line in stdin:
+            filename = line.strip()
+            if not filename:
+                continue
 
-    asmFile.close()
-    binOutFile.close()
+            print(f'{filename}:')
+            success = assemble(filename, filename + '.bin', verbose) and success
 
-    if error:
-        os.remove('output.bin')
-        print("Assembling unsuccessful ❌")
+    if not success:
         exit(1)
-    else:
-        print("Assembling successful ✅")
 
 
 if __name__ == '__main__':